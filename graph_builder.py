@@ -1,19 +1,12 @@
+import io
 import os
-import networkx as nx
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import yaml
-from tree_sitter_languages import get_language, get_parser
+from graph_common import YAML_DUMPER, GraphStore, cached_parser, compiled_query
 
 # --- CẤU HÌNH TREE-SITTER QUERIES (Section 4.2) ---
-# Query để tìm định nghĩa Hàm và Lớp
-
-DEF_QUERY_SCM = """
-(class_definition
-  name: (identifier) @class.name) @class.def
-
-(function_definition
-  name: (identifier) @function.name) @function.def
-"""
-
+# Định nghĩa Hàm và Lớp được lấy bằng TreeCursor (_walk_defs), không cần query
 
 # Query để tìm lời gọi hàm (Call sites)
 # Lưu ý: Đây là dạng đơn giản, chưa xử lý nested calls phức tạp
@@ -26,152 +19,207 @@ CALL_QUERY_SCM = """
     attribute: (identifier) @call.method)) @call.site
 """
 
-class RepoGraphBuilder:
+# Bảng sanitize ID cho Mermaid: thay "/", ".", ":" bằng "_" trong 1 lượt
+_SANITIZE = str.maketrans({'/': '_', '.': '_', ':': '_'})
+
+# Format cho từng dòng Mermaid, "\n" nằm sẵn ở đầu để write() nối liền
+_SUBGRAPH_FMT = '\n    subgraph "{0}"'
+_NODE_FMT = '\n        {0}["{1}"]'
+_END = '\n    end'
+_CALL_FMT = '\n    {0} -.-> {1}'
+
+def get_python_tools():
+    """Trả về (parser, call_query) cho Python, đã cache sẵn"""
+    return cached_parser('python'), compiled_query('python', CALL_QUERY_SCM)
+
+# Node định nghĩa -> loại node trong graph (class_definition / function_definition)
+_DEF_TYPES = {'class_definition': 'class', 'function_definition': 'function'}
+# Node không thể chứa class/def bên trong -> không cần đi xuống
+_SKIP_TYPES = {'expression_statement', 'return_statement', 'import_statement',
+               'import_from_statement', 'parameters', 'decorator', 'comment', 'string'}
+
+def _walk_defs(tree, code_bytes):
+    """Duyệt cây bằng TreeCursor (pre-order, đúng thứ tự như query) để lấy [(name, type)]"""
+    defs = []
+    cursor = tree.walk()
+    while True:
+        node = cursor.node
+        node_type = node.type
+        if node_type in _DEF_TYPES:
+            name_node = node.child_by_field_name('name')
+            if name_node is not None:
+                name = code_bytes[name_node.start_byte:name_node.end_byte].decode('utf8')
+                defs.append((name, _DEF_TYPES[node_type]))
+
+        if node_type not in _SKIP_TYPES and cursor.goto_first_child():
+            continue
+        while not cursor.goto_next_sibling():
+            if not cursor.goto_parent():
+                return defs
+
+def _parse_worker(args):
+    """Chạy trong process con: parse 1 file, trả về definitions + calls (không đụng tới graph)"""
+    repo_path, file_path = args
+    parser, call_query = get_python_tools()
+
+    # Đọc thẳng bytes (tree-sitter làm việc trên bytes, không cần decode rồi encode lại)
+    with open(file_path, "rb") as f:
+        code_bytes = f.read()
+    
+    # Parse đúng 1 lần, chạy cả query definitions và calls trên cùng tree
+    tree = parser.parse(code_bytes)
+    root_node = tree.root_node
+    rel_path = os.path.relpath(file_path, repo_path)
+
+    # Tìm Definitions (Class/Function) bằng cursor thay vì query
+    defs = _walk_defs(tree, code_bytes)
+
+    # --- LOGIC MỚI ---
+    # Giữ tên call ở dạng bytes để dedupe, chỉ decode khi resolve
+    found_calls = set()
+    for node, capture_name in call_query.captures(root_node):
+        # Nếu capture là @call.name -> lấy text trực tiếp
+        # Nếu capture là @call.method -> lấy text của method (bỏ qua object phía trước)
+        if capture_name in ["call.name", "call.method"]:
+            found_calls.add(code_bytes[node.start_byte:node.end_byte])
+
+    return rel_path, defs, found_calls
+
+class RepoGraphBuilder(GraphStore):
     def __init__(self, repo_path):
         self.repo_path = repo_path
-        self.graph = nx.DiGraph()
-        self.language = get_language('python')
-        self.parser = get_parser('python')
+        super().__init__()
         
-        # Từ điển toàn cục để map function_name -> [list of node_ids]
+        # Từ điển toàn cục để map function_name -> {set of node_ids}
         # Phục vụ cho "Naive Name Resolution" (Section 5.2)
-        self.global_definitions = {} 
+        self.global_definitions = defaultdict(set)
+
+        # Calls tìm được khi parse, theo rel_path -> khỏi parse lại ở resolve_dependencies
+        self._calls = {}
 
-    def get_node_id(self, file_path, name):
-        """Tạo ID duy nhất: path/to/file.py::function_name"""
-        rel_path = os.path.relpath(file_path, self.repo_path)
+    def get_node_id(self, rel_path, name):
+        """Tạo ID duy nhất: path/to/file.py::function_name (rel_path tính sẵn 1 lần/file)"""
         return f"{rel_path}::{name}"
 
     def parse_file(self, file_path):
         """Đọc file, parse AST và tạo Nodes"""
-        with open(file_path, "r", encoding="utf-8") as f:
-            code = f.read()
-        
-        tree = self.parser.parse(bytes(code, "utf8"))
-        root_node = tree.root_node
-        rel_path = os.path.relpath(file_path, self.repo_path)
+        self.add_parse_result(*_parse_worker((self.repo_path, file_path)))
+
+    def add_parse_result(self, rel_path, defs, found_calls):
+        """Ghi kết quả parse của 1 file vào graph (luôn chạy ở process chính)"""
+        self._calls[rel_path] = found_calls
 
         # 1. Tạo Node cho File
         file_node_id = rel_path
-        self.graph.add_node(file_node_id, type="file", path=rel_path)
+        self.add_node(file_node_id, type="file", path=rel_path)
 
-        # 2. Tìm Definitions (Class/Function)
-        query = self.language.query(DEF_QUERY_SCM)
-        captures = query.captures(root_node)
-        
-        for node, capture_name in captures:
-            if capture_name in ["class.name", "function.name"]:
-                name = code[node.start_byte:node.end_byte]
-                node_id = self.get_node_id(file_path, name)
-                node_type = "class" if capture_name == "class.name" else "function"
-                
-                # Thêm Node vào Graph
-                self.graph.add_node(node_id, type=node_type, name=name, file=rel_path)
-                
-                # Thêm cạnh "defines": File -> Function
-                self.graph.add_edge(file_node_id, node_id, relation="defines")
+        # 2. Tạo Node cho Definitions (Class/Function)
+        edges_buf = []
+        for name, node_type in defs:
+            node_id = self.get_node_id(rel_path, name)
+            
+            # Thêm Node vào Graph
+            self.add_node(node_id, type=node_type, name=name, file=rel_path)
+            
+            # Cạnh "defines": File -> Function (ghi 1 lần sau vòng lặp)
+            edges_buf.append((file_node_id, node_id))
 
-                # Lưu vào global dict để resolution sau này
-                if name not in self.global_definitions:
-                    self.global_definitions[name] = []
-                self.global_definitions[name].append(node_id)
+            # Lưu vào global dict để resolution sau này
+            self.global_definitions[name].add(node_id)
+        self.add_edges(edges_buf, relation="defines")
 
     def resolve_dependencies(self):
-        """Quét lại để tìm Calls và nối cạnh (Nâng cấp)"""
-        file_nodes = [n for n, attr in self.graph.nodes(data=True) if attr.get('type') == 'file']
-        
-        for file_node_id in file_nodes:
-            file_path = os.path.join(self.repo_path, file_node_id)
-            if not os.path.exists(file_path): continue
-            
-            with open(file_path, "r", encoding="utf-8") as f:
-                code = f.read()
-            tree = self.parser.parse(bytes(code, "utf8"))
-            
-            query = self.language.query(CALL_QUERY_SCM)
-            captures = query.captures(tree.root_node)
-            
-            # --- LOGIC MỚI ---
-            found_calls = set()
-            for node, capture_name in captures:
-                # Nếu capture là @call.name -> lấy text trực tiếp
-                # Nếu capture là @call.method -> lấy text của method (bỏ qua object phía trước)
-                if capture_name in ["call.name", "call.method"]:
-                    call_name = code[node.start_byte:node.end_byte]
-                    found_calls.add(call_name)
-            
+        """Dùng calls đã thu thập lúc parse để nối cạnh (Nâng cấp)"""
+        # Tên đã định nghĩa ở dạng bytes: giao với set calls để loại sớm (trong C)
+        # các call tới biến cục bộ/thư viện ngoài, trước khi decode và tra dict
+        defined = {name.encode('utf8') for name in self.global_definitions}
+
+        edges_buf = []
+        for file_node_id, found_calls in self._calls.items():
             # Tạo cạnh từ các call tìm được
-            for call_name in found_calls:
-                if call_name in self.global_definitions:
-                    possible_targets = self.global_definitions[call_name]
-                    for target_id in possible_targets:
-                        # Logic đơn giản: Nối File -> Function được gọi
-                        if target_id != file_node_id: 
-                            self.graph.add_edge(file_node_id, target_id, relation="calls")
-
-    def build(self):
+            for raw in found_calls & defined:
+                possible_targets = self.global_definitions[raw.decode('utf8')]
+                for target_id in possible_targets:
+                    # Logic đơn giản: Nối File -> Function được gọi
+                    if target_id != file_node_id: 
+                        edges_buf.append((file_node_id, target_id))
+        self.add_edges(edges_buf, relation="calls")
+        self._calls.clear()
+
+    def build(self, max_workers=None):
         """Quy trình Ingestion (Section 4.1)"""
+        paths = []
         for root, _, files in os.walk(self.repo_path):
             for file in files:
                 if file.endswith(".py"):
-                    full_path = os.path.join(root, file)
-                    self.parse_file(full_path)
+                    paths.append(os.path.join(root, file))
+
+        # Parse song song (CPU-bound), ghi graph tuần tự ở process chính
+        jobs = [(self.repo_path, path) for path in paths]
+        if max_workers == 1 or len(jobs) < 2:
+            for result in map(_parse_worker, jobs):
+                self.add_parse_result(*result)
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                for result in pool.map(_parse_worker, jobs, chunksize=16):
+                    self.add_parse_result(*result)
         
         self.resolve_dependencies()
-        print(f"Build xong! Nodes: {self.graph.number_of_nodes()}, Edges: {self.graph.number_of_edges()}")
+        print(f"Build xong! Nodes: {len(self.nodes)}, Edges: {self.number_of_edges()}")
 
     def export_mermaid(self):
         """Xuất ra Mermaid Chart (Section 6)"""
-        lines = ["flowchart TD"]
+        buf = io.StringIO()
+        write = buf.write
+        write("flowchart TD")
         
         # Group by File (Subgraphs)
-        files = [n for n, attr in self.graph.nodes(data=True) if attr['type'] == 'file']
+        files = [n for n, attr in self.nodes.items() if attr['type'] == 'file']
+        defines = self.out_index('defines')
         for f in files:
-            lines.append(f'    subgraph "{f}"')
+            write(_SUBGRAPH_FMT.format(f))
             # Tìm các hàm thuộc file này
-            children = [v for u, v, d in self.graph.out_edges(f, data=True) if d['relation'] == 'defines']
-            for child in children:
-                name = self.graph.nodes[child]['name']
+            for child in defines.get(f, []):
                 # Sanitize ID cho mermaid (thay thế ký tự lạ)
-                safe_id = child.replace("/", "_").replace(".", "_").replace(":", "_")
-                lines.append(f'        {safe_id}["{name}"]')
-            lines.append('    end')
+                write(_NODE_FMT.format(child.translate(_SANITIZE), self.nodes[child]['name']))
+            write(_END)
 
         # Vẽ cạnh Calls
-        for u, v, d in self.graph.edges(data=True):
-            if d['relation'] == 'calls':
-                # Tìm caller thực sự (ở đây đang đơn giản hóa là File gọi Function)
-                u_safe = u.replace("/", "_").replace(".", "_").replace(":", "_")
-                v_safe = v.replace("/", "_").replace(".", "_").replace(":", "_")
-                lines.append(f'    {u_safe} -.-> {v_safe}')
+        for u, v in self.edges_by_relation.get('calls', []):
+            # Tìm caller thực sự (ở đây đang đơn giản hóa là File gọi Function)
+            write(_CALL_FMT.format(u.translate(_SANITIZE), v.translate(_SANITIZE)))
         
-        return "\n".join(lines)
+        return buf.getvalue()
 
     def export_yaml(self):
         """Xuất ra YAML context cho LLM (Section 7.3)"""
         data = []
-        files = [n for n, attr in self.graph.nodes(data=True) if attr['type'] == 'file']
+        files = [n for n, attr in self.nodes.items() if attr['type'] == 'file']
+        defines = self.out_index('defines')
+        calls = self.out_index('calls')
         
         for f in files:
             file_obj = {"file": f, "functions": []}
-            children = [v for u, v, d in self.graph.out_edges(f, data=True) if d['relation'] == 'defines']
+            children = defines.get(f, [])
+
+            # Tìm xem hàm này/file này gọi đi đâu (Logic đơn giản hóa)
+            # Lưu ý: Trong code build hiện tại, edge 'calls' đi từ File -> Target Function
+            # Để chính xác hơn cần scope stack, nhưng tạm thời lấy từ File
+            # -> giống nhau cho mọi hàm trong file, chỉ tính 1 lần
+            outgoing = list(set(calls.get(f, []))) # Unique
             
             for child in children:
-                func_node = self.graph.nodes[child]
+                func_node = self.nodes[child]
                 func_obj = {
                     "name": func_node['name'],
-                    "calls": []
+                    # Copy list để yaml.dump không sinh anchor/alias
+                    "calls": list(outgoing)
                 }
-                # Tìm xem hàm này/file này gọi đi đâu (Logic đơn giản hóa)
-                # Lưu ý: Trong code build hiện tại, edge 'calls' đi từ File -> Target Function
-                # Để chính xác hơn cần scope stack, nhưng tạm thời lấy từ File
-                outgoing = [v for u, v, d in self.graph.out_edges(f, data=True) if d['relation'] == 'calls']
-                func_obj["calls"] = list(set(outgoing)) # Unique
                 
                 file_obj["functions"].append(func_obj)
             data.append(file_obj)
             
-        return yaml.dump(data, sort_keys=False, allow_unicode=True)
+        return yaml.dump(data, Dumper=YAML_DUMPER, sort_keys=False, allow_unicode=True)
 
 # --- CHẠY THỬ ---
 if __name__ == "__main__":
@@ -0,0 +1,53 @@
+from collections import defaultdict
+from functools import lru_cache
+import yaml
+from tree_sitter_languages import get_language, get_parser
+
+# Dùng emitter C của libyaml nếu có (nhanh hơn, ít bộ nhớ hơn)
+YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+# Cache language/parser/query ở mức module: dùng chung cho mọi builder trong cùng process
+cached_language = lru_cache(maxsize=None)(get_language)
+cached_parser = lru_cache(maxsize=None)(get_parser)
+
+@lru_cache(maxsize=64)
+def compiled_query(lang_name, scm):
+    """Compile query 1 lần cho mỗi cặp (ngôn ngữ, S-expression)"""
+    return cached_language(lang_name).query(scm)
+
+class GraphStore:
+    """Graph dạng phẳng dùng chung cho các builder: node_id -> attrs, relation -> [(u, v)]"""
+    def __init__(self):
+        self.nodes = {}
+        self.edges_by_relation = defaultdict(list)
+        self._edge_keys = defaultdict(set)
+
+    def add_node(self, node_id, **attrs):
+        self.nodes.setdefault(node_id, {}).update(attrs)
+
+    def add_edges(self, edges, relation):
+        """Thêm 1 lô cạnh cùng relation, bỏ qua cạnh trùng (giống DiGraph)"""
+        seen = self._edge_keys[relation]
+        new_edges = [edge for edge in dict.fromkeys(edges) if edge not in seen]
+        seen.update(new_edges)
+        self.edges_by_relation[relation].extend(new_edges)
+
+    def out_index(self, relation):
+        """Index 1 lượt: source -> [targets] cho 1 loại cạnh"""
+        index = {}
+        for u, v in self.edges_by_relation.get(relation, []):
+            index.setdefault(u, []).append(v)
+        return index
+
+    def number_of_edges(self):
+        return sum(len(edges) for edges in self.edges_by_relation.values())
+
+    def to_networkx(self):
+        """Chuyển sang nx.DiGraph khi cần dùng thuật toán của NetworkX"""
+        import networkx as nx
+        graph = nx.DiGraph()
+        for node_id, attrs in self.nodes.items():
+            graph.add_node(node_id, **attrs)
+        for relation, edges in self.edges_by_relation.items():
+            graph.add_edges_from(edges, relation=relation)
+        return graph
@@ -1,20 +1,151 @@
+import io
 import os
-import networkx as nx
 import yaml
 import re
-from tree_sitter_languages import get_language, get_parser
+import string
+import hashlib
+from collections import defaultdict
+from contextlib import nullcontext
+import json
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from itertools import compress
+from graph_common import YAML_DUMPER, GraphStore, cached_language, cached_parser, compiled_query
 
-class PolyglotGraphBuilder:
-    def __init__(self, repo_path):
+# pyahocorasick là tùy chọn: không có thì quay về cách quét substring
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# Mặc định nằm ở thư mục chạy lệnh, KHÔNG nằm trong repo đang quét
+CACHE_DB_NAME = ".graphcache.db"
+# Tăng khi đổi logic extract_definitions (lọc tên, bỏ quote, path YAML...) để bỏ cache cũ
+EXTRACTOR_VERSION = "1"
+
+# Bảng translate dựng sẵn (1 lượt C thay cho chuỗi .replace())
+_SANITIZE = str.maketrans({'/': '_', '.': '_', ':': '_', '-': '_', ' ': '_'})
+_STRIP_QUOTES = str.maketrans('', '', '"\'')
+
+# Template Mermaid dựng sẵn (mỗi template tự mang "\n" ở đầu)
+_SUBGRAPH_FMT = ('\n    subgraph cluster_{0} ["{1} ({2})"]'
+                 '\n        {0}["📄 {1}"]'
+                 '\n        style {0} fill:#f9f,stroke:#333,stroke-width:2px')
+_CHILD_FMT = '\n        {1}("{2} {3}")\n        {0} --- {1}'
+_END = '\n    end'
+_REF_FMT = '\n    {0} -.-> {1}'
+
+# Thư mục không cần quét (bị cắt khỏi os.walk)
+SKIP_DIRS = {'.git', 'venv', '__pycache__', 'node_modules', '.tox'}
+
+class ParseCache:
+    """Cache kết quả parse trong SQLite, key = (đường dẫn tuyệt đối, SHA-256 nội dung file, version của extractor)
+
+    Dùng đường dẫn tuyệt đối để nhiều repo quét chung 1 file cache không ghi đè lẫn nhau.
+
+    Tên definitions lưu dạng JSON (không dùng pickle vì file cache có thể đến từ nguồn lạ).
+    Dùng như context manager: mở kết nối, commit + đóng khi xong. Lỗi SQLite/decode = cache miss.
+    """
+    def __init__(self, db_path, version):
+        self.db_path = db_path
+        self.version = version
+        self.conn = None
+
+    def __enter__(self):
+        try:
+            self.conn = sqlite3.connect(self.db_path)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS definitions_cache "
+                "(path TEXT PRIMARY KEY, sha BLOB, version TEXT, defs TEXT, lang TEXT)"
+            )
+        except sqlite3.Error as e:
+            print(f"Không mở được cache {self.db_path}: {e}")
+            self.close()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.conn is not None:
+            try:
+                self.conn.commit()
+            except sqlite3.Error as e:
+                print(f"Không ghi được cache {self.db_path}: {e}")
+        self.close()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def get(self, path, sha):
+        """Trả về list definitions nếu file và extractor chưa đổi, ngược lại None"""
+        if self.conn is None: return None
+        try:
+            row = self.conn.execute(
+                "SELECT defs FROM definitions_cache WHERE path = ? AND sha = ? AND version = ?",
+                (path, sha, self.version)
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None: return None
+
+        # Row hỏng hoặc sai kiểu -> coi như miss
+        try:
+            names = json.loads(row[0])
+        except (TypeError, ValueError):
+            return None
+        if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+            return None
+        return names
+
+    def put(self, path, sha, defs, lang):
+        if self.conn is None: return
+        try:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO definitions_cache (path, sha, version, defs, lang) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (path, sha, self.version, json.dumps(defs), lang)
+            )
+        except sqlite3.Error as e:
+            print(f"Không ghi được cache cho {path}: {e}")
+
+def file_sha256(file_path):
+    """SHA-256 của file, đọc theo từng khối (không giữ cả file trong RAM)"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.digest()
+
+def scan_patterns(content, names):
+    """Trả về index các tên xuất hiện trong content (fallback khi không có pyahocorasick)"""
+    # map + compress chạy vòng lặp trong C; `in` dùng thuật toán tìm chuỗi C của CPython
+    return list(compress(range(len(names)), map(content.__contains__, names)))
+
+# Builder riêng cho mỗi process con của pool (query đã compile sẵn)
+_worker_builder = None
+
+def _init_worker():
+    global _worker_builder
+    _worker_builder = PolyglotGraphBuilder(None, use_cache=False)
+
+def _parse_worker(args):
+    """Chạy trong process con: đọc + parse 1 file, trả về (names, error, sha)"""
+    return _worker_builder.safe_extract(*args)
+
+class PolyglotGraphBuilder(GraphStore):
+    _INVALID_RE = re.compile(r'[^\w\-\.\:]')
+    _DROP_VALID = str.maketrans('', '', string.ascii_letters + string.digits + '_-.:')
+
+    def __init__(self, repo_path, use_cache=True, cache_path=CACHE_DB_NAME):
         self.repo_path = repo_path
-        self.graph = nx.DiGraph()
+        super().__init__()
         
         # --- CẤU HÌNH PARSER CHO TỪNG NGÔN NGỮ ---
         # --- CẤU HÌNH PARSER ĐÃ SỬA LỖI ---
         self.parsers = {
             '.py': {
-                'lang': get_language('python'),
-                'parser': get_parser('python'),
+                'lang': cached_language('python'),
+                'parser': cached_parser('python'),
                 'queries': {
                     'defs': """
                         (class_definition name: (identifier) @name) @def.class
@@ -27,8 +158,8 @@ class PolyglotGraphBuilder:
                 }
             },
             '.yaml': {
-                'lang': get_language('yaml'),
-                'parser': get_parser('yaml'),
+                'lang': cached_language('yaml'),
+                'parser': cached_parser('yaml'),
                 'queries': {
                     'defs': """
                         (block_mapping_pair key: (flow_node) @name) @def.key
@@ -40,8 +171,8 @@ class PolyglotGraphBuilder:
             
             # [FIXED] Dockerfile: Bỏ field "image:", chỉ match node con (image_spec)
             'Dockerfile': {
-                'lang': get_language('dockerfile'),
-                'parser': get_parser('dockerfile'),
+                'lang': cached_language('dockerfile'),
+                'parser': cached_parser('dockerfile'),
                 'queries': {
                     'defs': """
                         (from_instruction (image_spec) @name) @def.image
@@ -53,8 +184,8 @@ class PolyglotGraphBuilder:
             # [FIXED] Terraform/HCL: Bỏ field "type:" và "labels:", dựa vào thứ tự node con
             # Cấu trúc thường là: block -> identifier (resource type) -> string_lit (name)
             '.tf': { 
-                'lang': get_language('hcl'),
-                'parser': get_parser('hcl'),
+                'lang': cached_language('hcl'),
+                'parser': cached_parser('hcl'),
                 'queries': {
                     'defs': """
                         (block 
@@ -67,6 +198,16 @@ class PolyglotGraphBuilder:
             }
         }
         
+        # Compile query defs một lần cho mỗi ngôn ngữ (cache dùng chung giữa các builder)
+        for config in self.parsers.values():
+            if 'lang' in config:
+                lang_name = config['lang'].name
+                config['compiled_defs'] = compiled_query(lang_name, config['queries']['defs'])
+
+        # Cache AST trên đĩa: file không đổi thì bỏ qua tree-sitter
+        # Version gồm EXTRACTOR_VERSION + text các query defs -> đổi query là cache cũ tự bị bỏ qua
+        self.cache = ParseCache(cache_path, self.extractor_version()) if use_cache else None
+
         # Xử lý alias (ví dụ .yml -> .yaml)
         keys_to_add = {}
         for ext, config in self.parsers.items():
@@ -74,23 +215,33 @@ class PolyglotGraphBuilder:
                 keys_to_add[ext] = self.parsers[config['alias']]
         self.parsers.update(keys_to_add)
 
-    def get_node_id(self, file_path, name, kind=""):
-        rel_path = os.path.relpath(file_path, self.repo_path)
+    def extractor_version(self):
+        """Hash của EXTRACTOR_VERSION và query defs của mọi ngôn ngữ"""
+        digest = hashlib.sha256(EXTRACTOR_VERSION.encode('utf8'))
+        for key in sorted(self.parsers):
+            config = self.parsers[key]
+            if 'lang' in config:
+                digest.update(f"\0{key}\0{config['queries']['defs']}".encode('utf8'))
+        return digest.hexdigest()
+
+    def get_node_id(self, rel_path, name, kind=""):
         # Clean ID để tránh lỗi Mermaid/YAML
-        clean_name = name.replace('"', '').replace("'", "")
+        clean_name = name.translate(_STRIP_QUOTES)
         return f"{rel_path}::{clean_name}"
     def is_valid_identifier(self, name):
         if not name: return False
         # Chỉ chấp nhận chữ, số, _, -, . và :
-        if re.search(r'[^\w\-\.\:]', name): 
-            return False
-        return True
+        # Fast path: xóa các ký tự ASCII hợp lệ bằng translate, không còn gì -> hợp lệ
+        residue = name.translate(self._DROP_VALID)
+        if not residue: return True
+        # Còn ký tự khác (VD: chữ có dấu) -> kiểm tra bằng regex như cũ
+        return not self._INVALID_RE.search(residue)
 
     # --- [THÊM MỚI] Hàm leo cây để lấy path YAML (a.b.c) ---
     def get_yaml_full_path(self, node, code_bytes):
-        path = []
         current_text = code_bytes[node.start_byte:node.end_byte].decode('utf8')
-        path.append(current_text)
+        # Append từ lá lên gốc rồi đảo ngược 1 lần (tránh insert(0) O(n) mỗi bước)
+        path = [current_text]
         
         # Leo ngược lên cha
         curr = node.parent
@@ -99,204 +250,281 @@ class PolyglotGraphBuilder:
                 key_node = curr.child_by_field_name('key')
                 if key_node and key_node != node:
                     key_text = code_bytes[key_node.start_byte:key_node.end_byte].decode('utf8')
-                    path.insert(0, key_text)
+                    path.append(key_text)
             curr = curr.parent
-        return ".".join(path)
+        return ".".join(reversed(path))
 
     def parse_file(self, file_path):
-        filename = os.path.basename(file_path)
-        _, ext = os.path.splitext(filename)
-        
-        # Xử lý đặc biệt cho Dockerfile
-        if filename == 'Dockerfile': config = self.parsers.get('Dockerfile')
-        else: config = self.parsers.get(ext)
+        self.parse_files([file_path], max_workers=1)
 
-        if not config: return 
+    def parse_files(self, file_paths, max_workers=None):
+        """Tra cache tuần tự, parse song song các file cache miss, rồi ghi graph tuần tự"""
+        # Mở cache cho cả lô: commit + đóng kết nối khi xong (kể cả khi gọi parse_file lẻ)
+        with (self.cache or nullcontext()) as cache:
+            # 1. Tra cache ở process chính (chỉ hash từng file, không giữ nội dung)
+            jobs = []
+            for file_path in file_paths:
+                filename = os.path.basename(file_path)
+                _, ext = os.path.splitext(filename)
+            
+                # Xử lý đặc biệt cho Dockerfile
+                key = 'Dockerfile' if filename == 'Dockerfile' else ext
+                if not self.parsers.get(key): continue
 
-        rel_path = os.path.relpath(file_path, self.repo_path)
-        self.graph.add_node(rel_path, type="file", lang=ext or 'docker')
+                rel_path = os.path.relpath(file_path, self.repo_path)
+                job = {'file_path': file_path, 'rel_path': rel_path, 'lang': ext or 'docker',
+                       'cache_key': os.path.abspath(file_path),
+                       'key': key, 'ext': ext, 'names': None, 'error': None}
+                jobs.append(job)
+                if not cache: continue
 
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                code_str = f.read()
-            
-            # [QUAN TRỌNG] Chuyển sang bytes để xử lý tree-sitter chính xác vị trí
-            code_bytes = bytes(code_str, "utf8")
-            tree = config['parser'].parse(code_bytes)
-            
-            query = config['lang'].query(config['queries']['defs'])
-            captures = query.captures(tree.root_node)
-            
-            # Xử lý Captures (Hỗ trợ cả version cũ trả về list và mới trả về dict)
-            # Nếu captures là dict (version mới), ta convert sang list tuples để loop chung logic
-            if isinstance(captures, dict):
-                capture_list = []
-                for name, nodes in captures.items():
-                    for node in nodes:
-                        capture_list.append((node, name))
+                try:
+                    # Cache hit: dựng lại node trực tiếp, không cần parse
+                    job['names'] = cache.get(job['cache_key'], file_sha256(file_path))
+                except Exception as e:
+                    job['error'] = e
+
+            # 2. Parse các file cache miss (CPU-bound -> chia cho process pool)
+            # Worker chỉ nhận path, tự đọc + hash file -> process chính không giữ nội dung cả repo
+            misses = [job for job in jobs if job['names'] is None and job['error'] is None]
+            args = [(job['file_path'], job['key'], job['ext']) for job in misses]
+            if max_workers == 1 or len(args) < 2:
+                results = [self.safe_extract(*a) for a in args]
             else:
-                capture_list = captures
-
-            for node, capture_name in capture_list:
-                if capture_name == 'name': 
-                    name = ""
-                    # 1. Logic YAML Phân cấp (database -> database.db_host)
-                    if ext in ['.yaml', '.yml']:
-                        name = self.get_yaml_full_path(node, code_bytes)
-                    else:
-                        name = code_bytes[node.start_byte:node.end_byte].decode('utf8')
-
-                    # 2. Làm sạch tên
-                    name = name.replace('"', '').replace("'", "").strip()
-                    
-                    # 3. Lọc rác (Loại bỏ 'nt(' hoặc tên biến dị dạng)
-                    if not self.is_valid_identifier(name):
-                        continue
-
-                    # 4. Tạo Node
-                    node_id = self.get_node_id(file_path, name)
-                    self.graph.add_node(node_id, type="definition", name=name)
-                    self.graph.add_edge(rel_path, node_id, relation="contains")
-                    
-        except Exception as e:
-            print(f"Lỗi parse file {rel_path}: {e}")
-                    
+                with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker) as pool:
+                    results = list(pool.map(_parse_worker, args, chunksize=16))
+
+            for job, (names, error, sha) in zip(misses, results):
+                job['names'], job['error'] = names, error
+                if names is not None and cache:
+                    # Dùng sha của đúng nội dung worker đã parse
+                    cache.put(job['cache_key'], sha, names, job['lang'])
+
+        # 3. Ghi graph tuần tự theo đúng thứ tự file
+        for job in jobs:
+            rel_path = job['rel_path']
+            self.add_node(rel_path, type="file", lang=job['lang'])
+            if job['error'] is not None:
+                print(f"Lỗi parse file {rel_path}: {job['error']}")
+                continue
+
+            edges_buf = []
+            for name in job['names']:
+                # 4. Tạo Node
+                node_id = self.get_node_id(rel_path, name)
+                self.add_node(node_id, type="definition", name=name)
+                edges_buf.append((rel_path, node_id))
+            self.add_edges(edges_buf, relation="contains")
+
+    def safe_extract(self, file_path, key, ext):
+        """Đọc + parse 1 file, trả về (names, error, sha) để process con không làm hỏng cả pool"""
+        try:
+            # [QUAN TRỌNG] Đọc thẳng bytes để tree-sitter xử lý chính xác vị trí (không decode/encode thừa)
+            with open(file_path, "rb") as f:
+                code_bytes = f.read()
+            sha = hashlib.sha256(code_bytes).digest()
+            return self.extract_definitions(self.parsers[key], ext, code_bytes), None, sha
         except Exception as e:
-            print(f"Lỗi parse file {rel_path}: {e}")
+            return None, str(e), None
+
+    def extract_definitions(self, config, ext, code_bytes):
+        """Parse bằng tree-sitter và trả về list tên definitions hợp lệ"""
+        tree = config['parser'].parse(code_bytes)
+        
+        captures = config['compiled_defs'].captures(tree.root_node)
+        
+        # Xử lý Captures (Hỗ trợ cả version cũ trả về list và mới trả về dict)
+        # Nếu captures là dict (version mới), ta convert sang list tuples để loop chung logic
+        if isinstance(captures, dict):
+            capture_list = []
+            for name, nodes in captures.items():
+                for node in nodes:
+                    capture_list.append((node, name))
+        else:
+            capture_list = captures
+
+        names = []
+        for node, capture_name in capture_list:
+            if capture_name == 'name': 
+                name = ""
+                # 1. Logic YAML Phân cấp (database -> database.db_host)
+                if ext in ['.yaml', '.yml']:
+                    name = self.get_yaml_full_path(node, code_bytes)
+                else:
+                    name = code_bytes[node.start_byte:node.end_byte].decode('utf8')
+
+                # 2. Làm sạch tên
+                name = name.translate(_STRIP_QUOTES).strip()
+                
+                # 3. Lọc rác (Loại bỏ 'nt(' hoặc tên biến dị dạng)
+                if not self.is_valid_identifier(name):
+                    continue
+
+                names.append(name)
+        return names
 
     def build_cross_reference(self):
         print("Đang phân giải liên kết toàn bộ repo...")
-        definitions = {} 
+        # dict dùng như ordered set: gộp target trùng nhưng giữ thứ tự chèn
+        # -> thứ tự cạnh references không phụ thuộc PYTHONHASHSEED
+        definitions = defaultdict(dict)
         
-        # 1. Indexing: Gom tất cả định nghĩa lại
-        for node, attr in self.graph.nodes(data=True):
+        # 1. Indexing: Gom tất cả định nghĩa lại (1 lượt)
+        for node, attr in self.nodes.items():
             if attr.get('type') == 'definition':
                 name = attr.get('name')
                 if name:
                     # Lưu tên gốc (VD: database.db_host)
-                    if name not in definitions: definitions[name] = []
-                    definitions[name].append(node)
-                    
-                    # [QUAN TRỌNG] Tạo Alias cho các tên phân cấp
-                    # Giúp 'db_host' trong main.py tìm thấy 'database.db_host' trong yaml
-                    if "." in name:
-                        leaf_name = name.split(".")[-1]
-                        if leaf_name not in definitions: definitions[leaf_name] = []
-                        definitions[leaf_name].append(node)
+                    definitions[name][node] = None
+
+        # [QUAN TRỌNG] Tạo Alias cho các tên phân cấp (tính 1 lần sau khi index xong)
+        # Giúp 'db_host' trong main.py tìm thấy 'database.db_host' trong yaml
+        # Alias được chèn ngay sau tên gốc để giữ thứ tự pattern như lúc index
+        with_aliases = defaultdict(dict)
+        for name, nodes in definitions.items():
+            with_aliases[name].update(nodes)
+            if "." in name:
+                with_aliases[name.rsplit(".", 1)[-1]].update(nodes)
+        definitions = with_aliases
+
+        # Rule: Tên phải dài > 3 ký tự mới được coi là reference
+        patterns = [(def_name, target_nodes) for def_name, target_nodes in definitions.items() if len(def_name) > 3]
+        pattern_names = [def_name for def_name, _ in patterns]
+
+        # Gom tất cả tên vào 1 automaton Aho-Corasick -> mỗi file chỉ quét 1 lần
+        automaton = None
+        if ahocorasick and patterns:
+            automaton = ahocorasick.Automaton()
+            for idx, (def_name, _) in enumerate(patterns):
+                automaton.add_word(def_name, idx)
+            automaton.make_automaton()
 
         # 2. Scanning: Quét nội dung file để tìm reference
-        file_nodes = [n for n, a in self.graph.nodes(data=True) if a.get('type') == 'file']
+        file_nodes = [n for n, a in self.nodes.items() if a.get('type') == 'file']
         
+        # Gom toàn bộ cạnh references rồi ghi 1 lần
+        edges_buf = []
         for file_node in file_nodes:
             full_path = os.path.join(self.repo_path, file_node)
             try:
                 with open(full_path, "r", encoding="utf-8") as f:
                     content = f.read()
                 
-                for def_name, target_nodes in definitions.items():
-                    # Rule: Tên phải dài > 3 ký tự và xuất hiện trong content
-                    if len(def_name) > 3 and def_name in content:
-                        for target_node in target_nodes:
-                            # Không tự nối chính nó
-                            if not target_node.startswith(file_node):
-                                self.graph.add_edge(file_node, target_node, relation="references")
+                # Sắp xếp theo thứ tự index để giữ thứ tự cạnh ổn định
+                if automaton:
+                    matched = sorted({idx for _, idx in automaton.iter(content)})
+                else:
+                    matched = scan_patterns(content, pattern_names)
+
+                for idx in matched:
+                    for target_node in patterns[idx][1]:
+                        # Không tự nối chính nó
+                        if not target_node.startswith(file_node):
+                            edges_buf.append((file_node, target_node))
             except:
                 pass
+        self.add_edges(edges_buf, relation="references")
 
-    def build(self):
-        for root, _, files in os.walk(self.repo_path):
-            # Bỏ qua git, venv
-            if '.git' in root or 'venv' in root or '__pycache__' in root:
-                continue
+    def build(self, max_workers=None):
+        paths = []
+        ext_whitelist = set(self.parsers.keys())
+        for root, dirs, files in os.walk(self.repo_path):
+            # Bỏ qua git, venv... ngay từ lúc walk (không đi xuống các thư mục này)
+            dirs[:] = [d for d in dirs if d not in SKIP_DIRS]
             for file in files:
-                self.parse_file(os.path.join(root, file))
+                # Chỉ giữ file có parser, tránh đọc/tra cứu file thừa
+                if os.path.splitext(file)[1] in ext_whitelist or file == 'Dockerfile':
+                    paths.append(os.path.join(root, file))
+
+        self.parse_files(paths, max_workers=max_workers)
         
         self.build_cross_reference()
-        print(f"Build xong! Nodes: {self.graph.number_of_nodes()}, Edges: {self.graph.number_of_edges()}")
+        print(f"Build xong! Nodes: {len(self.nodes)}, Edges: {self.number_of_edges()}")
 
     def export_mermaid(self):
-        lines = ["flowchart TD"]
+        buf = io.StringIO()
+        write = buf.write
+        write("flowchart TD")
         
         def clean_id(text):
-            return text.replace("/", "_").replace(".", "_").replace(":", "_").replace("-", "_").replace(" ", "_")
+            return text.translate(_SANITIZE)
 
         # 1. Vẽ Subgraphs (Mỗi file là 1 cụm)
-        files = [n for n, a in self.graph.nodes(data=True) if a.get('type') == 'file']
+        files = [n for n, a in self.nodes.items() if a.get('type') == 'file']
+        contains = self.out_index('contains')
         
         for f in files:
             f_id = clean_id(f)
-            lang = self.graph.nodes[f].get('lang', '')
-            lines.append(f'    subgraph cluster_{f_id} ["{os.path.basename(f)} ({lang})"]')
-            
-            # Vẽ 1 node "Neo" đại diện cho chính file đó (để nối dây reference từ file này đi ra)
-            lines.append(f'        {f_id}["📄 {os.path.basename(f)}"]')
-            lines.append(f'        style {f_id} fill:#f9f,stroke:#333,stroke-width:2px')
+            lang = self.nodes[f].get('lang', '')
+            # Subgraph + 1 node "Neo" đại diện cho chính file đó (để nối dây reference từ file này đi ra)
+            write(_SUBGRAPH_FMT.format(f_id, os.path.basename(f), lang))
 
             # Vẽ các Definitions bên trong
-            children = [v for u, v, d in self.graph.out_edges(f, data=True) if d['relation'] == 'contains']
-            for child in children:
-                c_id = clean_id(child)
-                c_name = self.graph.nodes[child]['name']
-                # Icon tùy loại
-                icon = "🔧" if lang == '.py' else "🐳" if lang == 'Dockerfile' else "⚙️"
-                lines.append(f'        {c_id}("{icon} {c_name}")')
-                # Nối node File -> node Definition (quan hệ chứa)
-                lines.append(f'        {f_id} --- {c_id}')
+            # Icon tùy loại
+            icon = "🔧" if lang == '.py' else "🐳" if lang == 'Dockerfile' else "⚙️"
+            for child in contains.get(f, []):
+                # Node Definition + nối node File -> node Definition (quan hệ chứa)
+                write(_CHILD_FMT.format(f_id, clean_id(child), icon, self.nodes[child]['name']))
             
-            lines.append('    end')
+            write(_END)
 
         # 2. Vẽ Reference (Liên kết giữa các file)
         # Logic: File A (node neo) --> Definition B (node con của file khác)
-        for u, v, d in self.graph.edges(data=True):
-            if d['relation'] == 'references':
-                u_id = clean_id(u) # ID của File nguồn
-                v_id = clean_id(v) # ID của Def đích
-                lines.append(f'    {u_id} -.-> {v_id}')
+        for u, v in self.edges_by_relation.get('references', []):
+            # ID của File nguồn -.-> ID của Def đích
+            write(_REF_FMT.format(clean_id(u), clean_id(v)))
 
-        return "\n".join(lines)
+        return buf.getvalue()
     
-    def export_yaml_whole_repo(self, include_source=True): # Thêm tham số include_source
-        """Xuất YAML kèm theo Source Code để LLM review được"""
-        repo_data = []
-        file_nodes = [n for n, a in self.graph.nodes(data=True) if a.get('type') == 'file']
+    def export_yaml_whole_repo(self, out_path, include_source=True): # Thêm tham số include_source
+        """Xuất YAML kèm theo Source Code để LLM review được (ghi thẳng ra out_path từng file một)"""
+        file_nodes = [n for n, a in self.nodes.items() if a.get('type') == 'file']
+
+        # Index cạnh theo relation 1 lần: source -> [targets]
+        contains_by_file = self.out_index('contains')
+        refs_by_file = self.out_index('references')
         
-        for f_node in file_nodes:
-            file_path = os.path.join(self.repo_path, f_node)
-            
-            # Đọc nội dung file (nếu được yêu cầu)
-            source_content = ""
-            if include_source:
-                try:
-                    with open(file_path, "r", encoding="utf-8") as f:
-                        source_content = f.read()
-                except:
-                    source_content = "[Binary or Unreadable]"
-
-            file_entry = {
-                "path": f_node,
-                # Nhúng code vào đây để LLM đọc
-                "source_code": source_content, 
-                "definitions": [],
-                "references_to": []
-            }
-            
-            # ... (Phần logic lấy definitions và references giữ nguyên) ...
-            children = [v for u, v, d in self.graph.out_edges(f_node, data=True) if d['relation'] == 'contains']
-            for child in children:
-                file_entry["definitions"].append(self.graph.nodes[child]['name'])
-
-            refs = [v for u, v, d in self.graph.out_edges(f_node, data=True) if d['relation'] == 'references']
-            for ref in refs:
-                ref_name = self.graph.nodes[ref].get('name', ref)
-                file_entry["references_to"].append(ref_name)
-            
-            # Clean up empty lists
-            if not file_entry["definitions"]: del file_entry["definitions"]
-            if not file_entry["references_to"]: del file_entry["references_to"]
-            
-            repo_data.append(file_entry)
-            
-        return yaml.dump(repo_data, sort_keys=False, allow_unicode=True)
+        with open(out_path, "w", encoding="utf-8") as out:
+            if not file_nodes: out.write("[]\n")
+            for f_node in file_nodes:
+                # Mỗi entry dump thành 1 phần tử của list YAML -> không giữ cả repo trong RAM
+                entry = self._yaml_entry(f_node, contains_by_file, refs_by_file, include_source)
+                yaml.dump([entry], out, Dumper=YAML_DUMPER, sort_keys=False, allow_unicode=True)
+
+    def _yaml_entry(self, f_node, contains_by_file, refs_by_file, include_source):
+        """Dựng dict YAML cho 1 file"""
+        file_path = os.path.join(self.repo_path, f_node)
+        
+        # Đọc nội dung file (nếu được yêu cầu)
+        source_content = ""
+        if include_source:
+            try:
+                with open(file_path, "r", encoding="utf-8") as f:
+                    source_content = f.read()
+            except:
+                source_content = "[Binary or Unreadable]"
+
+        file_entry = {
+            "path": f_node,
+            # Nhúng code vào đây để LLM đọc
+            "source_code": source_content, 
+            "definitions": [],
+            "references_to": []
+        }
+        
+        # ... (Phần logic lấy definitions và references giữ nguyên) ...
+        for child in contains_by_file.get(f_node, []):
+            file_entry["definitions"].append(self.nodes[child]['name'])
+
+        for ref in refs_by_file.get(f_node, []):
+            ref_name = self.nodes[ref].get('name', ref)
+            file_entry["references_to"].append(ref_name)
+        
+        # Clean up empty lists
+        if not file_entry["definitions"]: del file_entry["definitions"]
+        if not file_entry["references_to"]: del file_entry["references_to"]
+        
+        return file_entry
 if __name__ == "__main__":
     # Thay đường dẫn tới repo của bạn
     REPO_PATH = "./simpler_repo/mini_polyglot_repo" 
@@ -305,8 +533,7 @@ if __name__ == "__main__":
     builder.build()
     
     # Lưu ra file để feed cho LLM
-    with open("whole_repo_context.yaml", "w", encoding="utf-8") as f:
-        f.write(builder.export_yaml_whole_repo())
+    builder.export_yaml_whole_repo("whole_repo_context.yaml")
 
     # 2. Xuất Mermaid để xem hình
     mermaid_code = builder.export_mermaid()